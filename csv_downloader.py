@@ -1,125 +1,382 @@
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional, Tuple
+
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import streamlit as st
 import requests
 from datetime import datetime, timezone
 
+# Threads shared by all sessions for background fetches; the HTTP connection pool is sized to match
+FETCH_WORKERS = 4
+# (connect, read) timeouts in seconds for Dune API calls, so a hung connection can't hold a worker forever
+REQUEST_TIMEOUT = (5, 60)
+# How long a click waits for its prefetch before giving up on it and fetching directly
+PREFETCH_WAIT_SECONDS = 10
+# Prefetched results older than this are thrown away, so a late click never shows outdated data
+PREFETCH_MAX_AGE_SECONDS = 60
+
+# Compiled once at import, since the file name is cleaned on every rerun of the download section
+_WHITESPACE_RE = re.compile(r"\s+")
+_UNSAFE_FILENAME_CHARS = str.maketrans({c: "_" for c in '\\/:"*?<>|'})
+# Dune column types whose values can exceed 64 bits, which orjson would round to floats.
+# Matched against the raw response body, so the parser can be chosen before parsing anything.
+_WIDE_NUMBER_TYPE_RE = re.compile(rb'"(u?int(128|256)|decimal)')
+# How Dune renders timestamp values, e.g. '2024-01-01 00:00:00.000 UTC'
+DUNE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f UTC"
+
 # --- Helper Functions ---
 
-@st.cache_data
-def convert_df_to_csv(df: pd.DataFrame) -> bytes:
-    """Converts a DataFrame to a UTF-8 encoded CSV file."""
-    return df.to_csv(index=False).encode('utf-8')
+def cell_to_text(value):
+    """Renders one value as CSV text, leaving missing values empty."""
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return value if isinstance(value, str) else str(value)
+
+@st.cache_data(max_entries=64)
+def convert_df_to_csv(_df: pd.DataFrame, execution_id: str) -> bytes:
+    """
+    Converts a DataFrame to a UTF-8 encoded CSV file.
+    The leading underscore stops Streamlit from hashing the whole DataFrame on every rerun;
+    the cache is keyed on the Dune execution ID instead, which identifies the result set.
+    Every column goes through Arrow's CSV writer, so the output format doesn't depend on what else is in the result.
+    """
+    arrays = []
+    for column in _df.columns:
+        try:
+            array = pa.array(_df[column], from_pandas=True)
+        except (pa.ArrowException, OverflowError):
+            # Mixed-type or beyond-64-bit integer columns: write them as text
+            array = None
+        if array is None or pa.types.is_nested(array.type):
+            # Arrow's CSV writer can't write nested values (e.g. Dune arrays) either
+            array = pa.array(_df[column].map(cell_to_text), type=pa.string(), from_pandas=True)
+        arrays.append(array)
+    table = pa.Table.from_arrays(arrays, names=[str(column) for column in _df.columns])
+    # Arrow's C++ writer emits UTF-8 bytes straight from the columnar buffers
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(table, sink)
+    return sink.getvalue().to_pybytes()
+
+@st.cache_data(max_entries=64)
+def convert_df_to_arrow(_df: pd.DataFrame, execution_id: str, timestamp_columns: Tuple[str, ...]) -> Optional[bytes]:
+    """
+    Converts a DataFrame to an Arrow IPC file, which is much smaller and faster to build than CSV.
+    Timestamp columns are stored as real timestamps rather than text.
+    Cached on the execution ID like convert_df_to_csv.
+    Returns None if the data has columns Arrow can't represent, such as integers beyond 64 bits.
+    """
+    try:
+        table = pa.Table.from_pandas(parse_timestamp_columns(_df, timestamp_columns), preserve_index=False)
+    except (pa.ArrowException, OverflowError):
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def safe_filename(name: str, default: str) -> str:
+    """
+    Cleans a user-supplied file name: collapses whitespace, replaces characters
+    that aren't allowed in file names, and makes sure it ends in .csv.
+    Falls back to the default name if nothing usable is left.
+    """
+    name = _WHITESPACE_RE.sub(" ", name).strip().translate(_UNSAFE_FILENAME_CHARS)
+    if not name:
+        return default
+    if not name.lower().endswith('.csv'):
+        name += '.csv'
+    return name
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    """
+    Returns a shared HTTP session for talking to the Dune API.
+    Reusing it across reruns keeps the connection to api.dune.com alive,
+    so repeat fetches skip the TCP/TLS handshake.
+    """
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json"})
+    # One pool per host, large enough that every fetch thread can hold a kept-alive connection
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Returns a thread pool shared across all user sessions for background fetches."""
+    return ThreadPoolExecutor(max_workers=FETCH_WORKERS)
 
-def fetch_dune_data(api_key: str, query_id: int) -> dict:
+def fetch_dune_csv(session: requests.Session, api_key: str, query_id: int) -> bytes:
+    """
+    Fetches query results from Dune's CSV endpoint.
+    Returns the CSV file exactly as Dune serves it, with no parsing on our side.
+    Raises an exception if the request fails.
+    """
+    url = f"https://api.dune.com/api/v1/query/{query_id}/results/csv"
+    headers = {"X-DUNE-API-KEY": api_key, "Accept": "text/csv"}
+
+    response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def timestamp_column_names(metadata: dict) -> Tuple[str, ...]:
+    """Returns the names of the columns Dune's result metadata types as timestamps."""
+    return tuple(
+        name for name, column_type in zip(metadata.get('column_names', []), metadata.get('column_types', []))
+        if column_type.startswith('timestamp')
+    )
+
+def parse_timestamp_columns(df: pd.DataFrame, timestamp_columns: Tuple[str, ...]) -> pd.DataFrame:
+    """
+    Returns a copy of the DataFrame with the given Dune timestamp columns parsed to datetimes.
+    Only the Arrow download and the preview need typed columns; the CSV keeps Dune's original text.
+    Dune's fixed format is passed explicitly so pandas doesn't fall back to parsing each value on its own.
+    Columns that don't match the format are left as text.
+    """
+    df = df.copy(deep=False)
+    for column in timestamp_columns:
+        if column not in df or df[column].dtype != object:
+            continue
+        try:
+            df[column] = pd.to_datetime(df[column], format=DUNE_TIMESTAMP_FORMAT, utc=True, cache=True)
+        except (ValueError, TypeError):
+            pass
+    return df
+
+@st.cache_resource(max_entries=8)
+def preview_frame(_df: pd.DataFrame, execution_id: str, timestamp_columns: Tuple[str, ...]) -> pd.DataFrame:
+    """
+    Returns the DataFrame shown in the preview, with timestamp columns typed.
+    Cached on the execution ID so the parsing happens once per result, not on every rerun.
+    """
+    return parse_timestamp_columns(_df, timestamp_columns)
+
+def fetch_dune_data(
+    session: requests.Session, api_key: str, query_id: int, etag: Optional[str] = None
+) -> Tuple[Optional[dict], Optional[str]]:
     """
     Fetches query results from the Dune API.
-    Returns the JSON response as a dictionary.
+    Returns the JSON response as a dictionary, along with the response's ETag.
+    If the ETag of an earlier fetch is passed and the results haven't changed since,
+    Dune answers 304 Not Modified and the dictionary is None.
     Raises an exception if the request fails.
+    The session is passed in so this can run on a background thread.
     """
     url = f"https://api.dune.com/api/v1/query/{query_id}/results"
     headers = {"X-DUNE-API-KEY": api_key}
+    if etag:
+        headers["If-None-Match"] = etag
     
-    response = requests.get(url, headers=headers)
+    response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        return None, etag
     # Raise an HTTPError if the HTTP request returned an unsuccessful status code
     response.raise_for_status() 
-    return response.json()
+    if _WIDE_NUMBER_TYPE_RE.search(response.content):
+        # orjson turns integers beyond 64 bits into floats; the stdlib parser keeps them exact (e.g. uint256 token amounts).
+        # A text value that happens to look like one of these types only costs the slower parser, never precision.
+        response_json = json.loads(response.content)
+    else:
+        # orjson parses the raw bytes directly, skipping the intermediate str that response.json() builds
+        response_json = orjson.loads(response.content)
+    return response_json, response.headers.get("ETag")
 
 # --- Streamlit App UI ---
 
 st.set_page_config(layout="centered", page_title="Dune CSV Downloader")
 st.title('Dune CSV Downloader 📊')
 
-# --- User Inputs ---
+# --- Inputs & Fetching ---
 # Use session state to hold onto the API key and query ID
 if 'user_api_key' not in st.session_state:
     st.session_state.user_api_key = ''
 if 'query_id' not in st.session_state:
     st.session_state.query_id = 2833363 # A default public query ID
 
-st.session_state.user_api_key = st.text_input(
-    label='Enter your Dune API Key',
-    placeholder='Enter your key here...',
-    value=st.session_state.user_api_key,
-    type='password',  # Hides the API key for security
-    help="You can find your API key on your Dune Analytics user settings page."
-)
-
-st.session_state.query_id = st.number_input(
-    label='Enter the Dune Query ID',
-    min_value=1,
-    step=1,
-    format="%d",
-    value=st.session_state.query_id,
-    help="The ID of the query you want to fetch results from."
-)
-
-# --- Main Logic ---
-if st.button('🚀 Get Query Results', use_container_width=True):
-    # Validate inputs first
-    if not st.session_state.user_api_key:
-        st.warning('Please enter your Dune API key to proceed.', icon="🔑")
-    elif not st.session_state.query_id:
-        st.warning('Please enter a valid Query ID.', icon="🔢")
-    else:
-        with st.spinner(f'Fetching results for Query ID: {st.session_state.query_id}...'):
-            try:
-                # 1. Fetch data from API
-                response_json = fetch_dune_data(st.session_state.user_api_key, st.session_state.query_id)
-                
-                # 2. Process the response
-                if 'result' in response_json and 'rows' in response_json['result']:
-                    data_rows = response_json['result']['rows']
-                    # Check if there are any rows to process
-                    if data_rows:
-                        # 💡 FIX: Get the original column order from the first row's keys
-                        original_column_order = list(data_rows[0].keys())
-                        
-                        # Create the DataFrame (columns will be sorted alphabetically here)
-                        df = pd.DataFrame(data_rows)
-                        
-                        # 💡 FIX: Reorder the DataFrame to match the original order
-                        df = df[original_column_order]
+@st.fragment
+def query_section():
+    """
+    Renders the inputs and the fetch button, and runs the fetch.
+    As a fragment, editing the inputs reruns only this block instead of re-sending the results preview below.
+    Errors are shown here and leave any earlier results in place; only a successful fetch reruns the whole app.
+    """
+    st.session_state.user_api_key = st.text_input(
+        label='Enter your Dune API Key',
+        placeholder='Enter your key here...',
+        value=st.session_state.user_api_key,
+        type='password',  # Hides the API key for security
+        help="You can find your API key on your Dune Analytics user settings page."
+    )
+
+    st.session_state.query_id = st.number_input(
+        label='Enter the Dune Query ID',
+        min_value=1,
+        step=1,
+        format="%d",
+        value=st.session_state.query_id,
+        help="The ID of the query you want to fetch results from."
+    )
+
+    # --- Prefetch ---
+    # Start fetching in the background as soon as both inputs are filled in,
+    # so the results are usually ready by the time the button is clicked
+    prefetch_key = (st.session_state.user_api_key, st.session_state.query_id)
+    # Revalidate only when the results on screen are for this query, since a 304 reuses them
+    has_current_results = (
+        st.session_state.get('df_to_download') is not None
+        and st.session_state.get('result_query_id') == st.session_state.query_id
+    )
+    known_etag = st.session_state.get('result_etag') if has_current_results else None
+    if st.session_state.user_api_key and st.session_state.query_id and st.session_state.get('prefetch_key') != prefetch_key:
+        # The inputs changed, so any earlier prefetch is stale
+        stale_future = st.session_state.get('prefetch_future')
+        if stale_future is not None:
+            stale_future.cancel()
+        st.session_state.prefetch_future = get_executor().submit(fetch_dune_data, get_session(), *prefetch_key, known_etag)
+        st.session_state.prefetch_key = prefetch_key
+        st.session_state.prefetch_submitted_at = time.monotonic()
+    elif (
+        st.session_state.get('prefetch_future') is not None
+        and time.monotonic() - st.session_state.prefetch_submitted_at > PREFETCH_MAX_AGE_SECONDS
+    ):
+        # Too old to show as fresh; drop it so its parsed JSON doesn't sit in session state
+        st.session_state.prefetch_future.cancel()
+        st.session_state.prefetch_future = None
+
+    # --- Main Logic ---
+    results_ready = False
+    col_preview, col_csv = st.columns(2)
+    get_results = col_preview.button('🚀 Get Query Results', use_container_width=True)
+    get_csv_only = col_csv.button(
+        '📄 Get CSV Only',
+        use_container_width=True,
+        help="Skips the preview and downloads Dune's own CSV export. Quicker for big results."
+    )
+    if get_results or get_csv_only:
+        # Validate inputs first
+        if not st.session_state.user_api_key:
+            st.warning('Please enter your Dune API key to proceed.', icon="🔑")
+        elif not st.session_state.query_id:
+            st.warning('Please enter a valid Query ID.', icon="🔢")
+        else:
+            with st.spinner(f'Fetching results for Query ID: {st.session_state.query_id}...'):
+                try:
+                    if get_csv_only:
+                        # Dune already serves the CSV, so skip the JSON -> DataFrame -> CSV round trip
+                        # Kept for as long as this result is shown, so the download section never has to fetch again
+                        st.session_state.csv_to_download = fetch_dune_csv(get_session(), *prefetch_key)
+                        st.session_state.df_to_download = None
+                        st.session_state.result_query_id = st.session_state.query_id
+                        results_ready = True
                     else:
-                        # If no rows, create an empty DataFrame
-                        df = pd.DataFrame()
-                    
+                        # 1. Fetch data from API, using the prefetched result when it matches the inputs
+                        prefetch_future = st.session_state.pop('prefetch_future', None)
+                        response = None
+                        if (
+                            prefetch_future is not None
+                            and st.session_state.prefetch_key == prefetch_key
+                            and time.monotonic() - st.session_state.prefetch_submitted_at <= PREFETCH_MAX_AGE_SECONDS
+                        ):
+                            try:
+                                response = prefetch_future.result(timeout=PREFETCH_WAIT_SECONDS)
+                            except FutureTimeoutError:
+                                # Still queued behind other sessions' prefetches, or stuck; fetch directly instead
+                                prefetch_future.cancel()
+                        if response is None:
+                            response = fetch_dune_data(get_session(), *prefetch_key, known_etag)
+                        response_json, etag = response
+                        if response_json is None and known_etag is None:
+                            # The prefetch revalidated results that have since been cleared, so fetch them in full
+                            response_json, etag = fetch_dune_data(get_session(), *prefetch_key)
+                
+                        # 2. Process the response
+                        if response_json is None:
+                            # 304 Not Modified: the results already on screen are still current
+                            st.info("The results haven't changed since the last fetch.", icon="♻️")
+                        elif 'result' in response_json and 'rows' in response_json['result']:
+                            # pandas keeps the first-seen key order for a list of dicts, so Dune's column order survives
+                            df = pd.DataFrame(response_json['result']['rows'])
                     
-                    # Store dataframe in session state to use for downloading
-                    st.session_state.df_to_download = df 
+                            # Store dataframe in session state to use for downloading
+                            st.session_state.df_to_download = df 
+                            st.session_state.csv_to_download = None
+                            # Keep only small metadata alongside the DataFrame; the CSV bytes are derived from it on demand
+                            st.session_state.result_query_id = st.session_state.query_id
+                            # The execution ID identifies this result set and keys the CSV cache
+                            st.session_state.execution_id = response_json.get(
+                                'execution_id', f"{st.session_state.query_id}_{datetime.now(timezone.utc).isoformat()}"
+                            )
+                            # Sent as If-None-Match next time, so an unchanged result costs a single round trip
+                            st.session_state.result_etag = etag
+                            # Parsed only for the preview and the Arrow download; the CSV keeps Dune's text
+                            st.session_state.timestamp_columns = timestamp_column_names(
+                                response_json['result'].get('metadata', {})
+                            )
                     
-                    st.success(f"Successfully retrieved {len(df)} rows!", icon="✅")
-                    st.dataframe(df)
-                else:
-                    st.error("The API response was not in the expected format. It might be an execution error on Dune's side.", icon="👎")
-                    st.json(response_json) # Show the actual response for debugging
-                    st.session_state.df_to_download = None
-
-
-            except requests.exceptions.HTTPError as e:
-                st.error(f"An HTTP error occurred: {e.response.status_code} {e.response.reason}", icon="🚨")
-                st.error("Please check if your API Key is correct and the Query ID is valid.", icon="🧐")
-                st.session_state.df_to_download = None
-            except requests.exceptions.RequestException as e:
-                st.error(f"A network error occurred: {e}", icon="🌐")
-                st.session_state.df_to_download = None
-            except Exception as e:
-                st.error(f"An unexpected error occurred: {e}", icon="💥")
-                st.session_state.df_to_download = None
+                            results_ready = True
+                        else:
+                            st.error("The API response was not in the expected format. It might be an execution error on Dune's side.", icon="👎")
+                            st.json(response_json) # Show the actual response for debugging
+
+
+                except requests.exceptions.HTTPError as e:
+                    st.error(f"An HTTP error occurred: {e.response.status_code} {e.response.reason}", icon="🚨")
+                    st.error("Please check if your API Key is correct and the Query ID is valid.", icon="🧐")
+                except requests.exceptions.RequestException as e:
+                    st.error(f"A network error occurred: {e}", icon="🌐")
+                except Exception as e:
+                    st.error(f"An unexpected error occurred: {e}", icon="💥")
+
+        if results_ready:
+            # New results live outside this fragment, so rerun the whole app once to show them
+            st.rerun()
+
+query_section()
 
 # --- Download Section ---
-# Only show the download section if a dataframe is available in the session state
-if 'df_to_download' in st.session_state and st.session_state.df_to_download is not None:
-    st.markdown("---")
-    
+def clear_results():
+    """
+    Forgets the current results.
+    Used as an on_click callback, so it runs before the rerun the click already triggers and no second rerun is needed.
+    """
+    st.session_state.df_to_download = None
+    st.session_state.csv_to_download = None
+
+@st.fragment
+def download_section():
+    """
+    Renders the file name input and the download button.
+    As a fragment, editing the file name reruns only this block, not the fetch logic or the preview above it.
+    """
     # Generate a dynamic file name
     utc_timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
 
-    file_name=st.text_input(label='Enter file name')
-    if not file_name:
-        file_name = f"dune_query_{st.session_state.query_id}_{utc_timestamp}.csv"
+    file_name = safe_filename(
+        st.text_input(label='Enter file name'),
+        default=f"dune_query_{st.session_state.result_query_id}_{utc_timestamp}.csv"
+    )
 
+    df = st.session_state.get('df_to_download')
+    if df is None:
+        # CSV-only fetch: serve Dune's bytes as they came
+        st.download_button(
+            label="📥 Download Results as CSV",
+            data=st.session_state.csv_to_download,
+            file_name=file_name,
+            mime="text/csv",
+            use_container_width=True,
+            key='download-csv'
+        )
+        return
 
-    csv_data = convert_df_to_csv(st.session_state.df_to_download)
+    # Cached on the execution ID alone, so a file name change never touches the DataFrame
+    csv_data = convert_df_to_csv(df, st.session_state.execution_id)
 
     st.download_button(
         label="📥 Download Results as CSV",
@@ -129,3 +386,48 @@ if 'df_to_download' in st.session_state and st.session_state.df_to_download is n
         use_container_width=True,
         key='download-csv'
     )
+
+    arrow_data = convert_df_to_arrow(df, st.session_state.execution_id, st.session_state.timestamp_columns)
+    if arrow_data is not None:
+        st.download_button(
+            label="📦 Download Results as Arrow",
+            data=arrow_data,
+            file_name=file_name[:-len('.csv')] + '.arrow',  # safe_filename always ends in .csv
+            mime="application/vnd.apache.arrow.file",
+            use_container_width=True,
+            key='download-arrow'
+        )
+
+# Only show the download section if some results are available in the session state
+if st.session_state.get('df_to_download') is not None:
+    # Results stay up if a later fetch fails, so label which query they belong to
+    st.success(
+        f"Successfully retrieved {len(st.session_state.df_to_download)} rows for Query ID: {st.session_state.result_query_id}",
+        icon="✅"
+    )
+    preview_df = preview_frame(
+        st.session_state.df_to_download, st.session_state.execution_id, st.session_state.timestamp_columns
+    )
+    # Preview the full result. The whole frame is sent to the browser as Arrow on every full-app rerun;
+    # only the grid's drawing is virtualized, which is why the inputs and downloads run as fragments
+    try:
+        st.dataframe(preview_df, height=400)
+    except OverflowError:
+        # Arrow can't hold integers beyond 64 bits (e.g. uint256 amounts), so preview those values as text
+        st.dataframe(
+            preview_df.apply(
+                lambda column: column.map(lambda value: str(value) if isinstance(value, int) else value)
+                if column.dtype == object else column
+            ),
+            height=400
+        )
+
+    st.markdown("---")
+    download_section()
+    st.button("🧹 Clear Results", on_click=clear_results, use_container_width=True)
+elif st.session_state.get('csv_to_download') is not None:
+    st.success(f"CSV for Query ID: {st.session_state.result_query_id} is ready to download.", icon="✅")
+
+    st.markdown("---")
+    download_section()
+    st.button("🧹 Clear Results", on_click=clear_results, use_container_width=True)